@@ -3,6 +3,12 @@
 import os
 import xmlrpclib
 import urllib
+import httplib
+import socket
+import collections
+import threading
+import time
+import Queue
 
 # Helper function to check if URL exists
 
@@ -24,16 +30,452 @@ class BlogError(Exception):
 
 	__str__ = __repr__   
 		
+class StreamingUnmarshaller(object):
+	"""
+	Parser target that unmarshals the elements of an array response one at a time.
+	
+	Each element of the top-level array is unmarshalled by its own
+	xmlrpclib.Unmarshaller as soon as its closing </value> has been parsed,
+	so only one element is held in memory at a time. A <fault> response
+	raises xmlrpclib.Fault.
+	"""
+	
+	# Path of the element values inside an array response
+	item_path = ['methodResponse', 'params', 'param', 'value', 'array', 'data']
+	
+	def __init__(self, use_datetime=0):
+		self.use_datetime = use_datetime
+		self.items = collections.deque()
+		self._path = []
+		self._item = None
+		self._item_depth = None
+		self._fault = None
+		self._encoding = None
+	
+	def _unmarshaller(self):
+		u = xmlrpclib.Unmarshaller(self.use_datetime)
+		u.xml(self._encoding, None)
+		return u
+	
+	def xml(self, encoding, standalone):
+		self._encoding = encoding
+	
+	def start(self, tag, attrs):
+		if self._item is not None:
+			self._item.start(tag, attrs)
+		elif self._fault is not None:
+			self._fault.start(tag, attrs)
+		elif tag == 'fault' and self._path == ['methodResponse']:
+			self._fault = self._unmarshaller()
+			self._fault.start(tag, attrs)
+		elif tag == 'value' and self._path == self.item_path:
+			# Wrap each element in <params> so Unmarshaller.close() accepts it
+			self._item = self._unmarshaller()
+			self._item.start('params', {})
+			self._item.start(tag, attrs)
+			self._item_depth = len(self._path)
+		elif self._path == self.item_path[:4] and tag != 'array':
+			raise BlogError("Expected an array response, got <%s>" % tag)
+		self._path.append(tag)
+	
+	def data(self, text):
+		if self._item is not None:
+			self._item.data(text)
+		elif self._fault is not None:
+			self._fault.data(text)
+	
+	def end(self, tag):
+		self._path.pop()
+		if self._item is not None:
+			self._item.end(tag)
+			if tag == 'value' and len(self._path) == self._item_depth:
+				self._item.end('params')
+				self.items.append(self._item.close()[0])
+				self._item = None
+		elif self._fault is not None:
+			self._fault.end(tag)
+			if tag == 'fault':
+				# Raises xmlrpclib.Fault
+				self._fault.close()
+
+class TimeoutTransport(xmlrpclib.Transport):
+	"""
+	xmlrpclib transport whose socket operations time out after timeout seconds.
+	"""
+	
+	def __init__(self, timeout, use_datetime=0):
+		xmlrpclib.Transport.__init__(self, use_datetime)
+		self.timeout = timeout
+	
+	def make_connection(self, host):
+		h = xmlrpclib.Transport.make_connection(self, host)
+		h.timeout = self.timeout
+		return h
+
+class SafeTimeoutTransport(xmlrpclib.SafeTransport):
+	"""
+	HTTPS version of TimeoutTransport.
+	"""
+	
+	def __init__(self, timeout, use_datetime=0):
+		xmlrpclib.SafeTransport.__init__(self, use_datetime)
+		self.timeout = timeout
+	
+	def make_connection(self, host):
+		h = xmlrpclib.SafeTransport.make_connection(self, host)
+		h.timeout = self.timeout
+		return h
+
+class Endpoint(object):
+	"""
+	One XML-RPC URL in an EndpointPool.
+	"""
+	
+	def __init__(self, url):
+		self.url = url
+		self.healthy = True
+		self.failed_at = None
+		# Guards healthy/failed_at, which hedged calls update from other threads
+		self._lock = threading.Lock()
+		# xmlrpclib transports are not thread-safe; keep one proxy per thread
+		self._local = threading.local()
+	
+	def proxy(self):
+		if getattr(self._local, 'proxy', None) is None:
+			self._local.proxy = xmlrpclib.ServerProxy(self.url)
+		return self._local.proxy
+	
+	def health_proxy(self, timeout):
+		"""
+		Returns this thread's proxy for health checks, which gives up after
+		timeout seconds so a hung server can't block the check.
+		"""
+		if getattr(self._local, 'health_proxy', None) is None:
+			if urllib.splittype(self.url)[0] == 'https':
+				transport = SafeTimeoutTransport(timeout)
+			else:
+				transport = TimeoutTransport(timeout)
+			self._local.health_proxy = xmlrpclib.ServerProxy(self.url, transport=transport)
+		return self._local.health_proxy
+	
+	def mark_down(self):
+		with self._lock:
+			self.healthy = False
+			self.failed_at = time.time()
+		self._local.proxy = None
+		self._local.health_proxy = None
+	
+	def mark_up(self):
+		with self._lock:
+			self.healthy = True
+			self.failed_at = None
+	
+	def in_rotation(self, retry_after, now=None):
+		"""
+		Returns True if the endpoint is healthy, or failed at least
+		retry_after seconds ago.
+		"""
+		if now is None:
+			now = time.time()
+		with self._lock:
+			return self.healthy or now - self.failed_at >= retry_after
+	
+	def stream(self, methodname, params, chunk_size=8192):
+		"""
+		Calls methodname and yields the elements of the array it returns as
+		they are parsed off the socket.
+		"""
+		type, uri = urllib.splittype(self.url)
+		host, handler = urllib.splithost(uri)
+		if type == 'https':
+			transport = xmlrpclib.SafeTransport()
+		else:
+			transport = xmlrpclib.Transport()
+		# A gzipped body can't be parsed incrementally
+		transport.accept_gzip_encoding = False
+		
+		body = xmlrpclib.dumps(params, methodname, encoding='utf-8')
+		target = StreamingUnmarshaller()
+		parser = xmlrpclib.ExpatParser(target)
+		try:
+			h = transport.make_connection(host)
+			transport.send_request(h, handler or '/RPC2', body)
+			transport.send_host(h, host)
+			transport.send_user_agent(h)
+			transport.send_content(h, body)
+			response = h.getresponse()
+			if response.status != 200:
+				raise xmlrpclib.ProtocolError(host + (handler or '/RPC2'),
+					response.status, response.reason, response.msg)
+			
+			while True:
+				chunk = response.read(chunk_size)
+				if not chunk:
+					break
+				parser.feed(chunk)
+				while target.items:
+					yield target.items.popleft()
+			parser.close()
+			while target.items:
+				yield target.items.popleft()
+		except EndpointPool.transport_errors:
+			self.mark_down()
+			raise
+		finally:
+			transport.close()
+	
+	def __repr__(self):
+		return '<Endpoint %s%s>' % (self.url, '' if self.healthy else ' (down)')
+
+class EndpointPool(object):
+	"""
+	Spreads read-only XML-RPC calls across several URLs serving the same blog.
+	
+	Calls are made round-robin across healthy endpoints and fail over to the
+	next endpoint on a transport error. An endpoint that fails is taken out
+	of rotation for retry_after seconds, or until check_health() finds it
+	responding again.
+	
+	If health_interval is set, check_health() runs in a background thread
+	every health_interval seconds, and a failed endpoint stays out of
+	rotation until a health check passes rather than for retry_after seconds.
+	Otherwise health checks only run when the caller invokes check_health().
+	
+	If hedge_percentile is set (e.g. 95), a second request is sent to another
+	endpoint once a call has taken longer than that percentile of recent call
+	latencies, and whichever answers first is returned.
+	"""
+	
+	# Transport-level failures; a Fault means the endpoint itself is working
+	transport_errors = (socket.error, xmlrpclib.ProtocolError, httplib.HTTPException)
+	
+	def __init__(self, urls, hedge_percentile=None, retry_after=30, window=100, min_samples=20, health_interval=None, health_timeout=5):
+		"""
+		Args:
+			urls (list): XML-RPC API URLs.
+			hedge_percentile (float): Latency percentile after which a hedged request is sent [optional]
+			retry_after (float): Seconds a failed endpoint is kept out of rotation.
+			window (int): Number of recent latencies kept for the percentile.
+			min_samples (int): Latencies needed before hedging starts.
+			health_interval (float): Seconds between background health checks [optional]
+			health_timeout (float): Seconds before a health check counts as failed.
+		"""
+		if not urls:
+			raise BlogError('No XML-RPC API URL passed')
+		self.endpoints = [Endpoint(url) for url in urls]
+		self.hedge_percentile = hedge_percentile
+		self.retry_after = retry_after
+		self.min_samples = min_samples
+		self._latencies = collections.deque(maxlen=window)
+		self._lock = threading.Lock()
+		self._next = 0
+		self.health_interval = health_interval
+		self.health_timeout = health_timeout
+		self._stopped = threading.Event()
+		if health_interval is not None:
+			t = threading.Thread(target=self._check_health_loop)
+			t.daemon = True
+			t.start()
+	
+	def _check_health_loop(self):
+		while not self._stopped.wait(self.health_interval):
+			self.check_health()
+	
+	def close(self):
+		"""Stops the background health checks."""
+		self._stopped.set()
+	
+	def __len__(self):
+		return len(self.endpoints)
+	
+	def healthy(self):
+		"""Returns the endpoints currently in rotation."""
+		now = time.time()
+		if self.health_interval is not None:
+			# Failed endpoints come back only through check_health()
+			return [e for e in self.endpoints if e.healthy]
+		return [e for e in self.endpoints if e.in_rotation(self.retry_after, now)]
+	
+	def rotation(self):
+		"""
+		Returns the endpoints in the order the next call should try them:
+		healthy endpoints from the next round-robin position, then the rest
+		so a call is still attempted if everything is marked down.
+		"""
+		healthy = self.healthy()
+		with self._lock:
+			start = self._next
+			self._next += 1
+		if healthy:
+			start = start % len(healthy)
+			healthy = healthy[start:] + healthy[:start]
+		return healthy + [e for e in self.endpoints if e not in healthy]
+	
+	def _record(self, latency):
+		with self._lock:
+			self._latencies.append(latency)
+	
+	def hedge_delay(self):
+		"""
+		Returns the latency (in seconds) after which a hedged request is sent,
+		or None if hedging is off or there are too few samples yet.
+		"""
+		if self.hedge_percentile is None:
+			return None
+		with self._lock:
+			if len(self._latencies) < self.min_samples:
+				return None
+			samples = sorted(self._latencies)
+		index = int(round(self.hedge_percentile / 100.0 * (len(samples) - 1)))
+		return samples[min(max(index, 0), len(samples) - 1)]
+	
+	def _call_one(self, endpoint, methodname, params):
+		start = time.time()
+		try:
+			r = getattr(endpoint.proxy(), methodname)(*params)
+		except xmlrpclib.Fault:
+			endpoint.mark_up()
+			raise
+		except self.transport_errors:
+			endpoint.mark_down()
+			raise
+		self._record(time.time() - start)
+		endpoint.mark_up()
+		return r
+	
+	def call(self, methodname, params):
+		"""
+		Calls methodname with params on the pool.
+		
+		Args:
+			methodname (str): XML-RPC method name.
+			params (tuple): Positional parameters of the call.
+		"""
+		rotation = self.rotation()
+		delay = self.hedge_delay()
+		if delay is not None and len(self.healthy()) > 1:
+			return self._call_hedged(rotation, delay, methodname, params)
+		
+		error = None
+		for endpoint in rotation:
+			try:
+				return self._call_one(endpoint, methodname, params)
+			except self.transport_errors, e:
+				error = e
+		raise error
+	
+	def stream(self, methodname, params):
+		"""
+		Streams the array returned by methodname, as Endpoint.stream does.
+		Fails over to the next endpoint on a transport error raised before
+		the first element has been yielded.
+		"""
+		error = None
+		for endpoint in self.rotation():
+			started = False
+			try:
+				for item in endpoint.stream(methodname, params):
+					started = True
+					yield item
+				return
+			except self.transport_errors, e:
+				if started:
+					raise
+				error = e
+		raise error
+	
+	def _call_hedged(self, rotation, delay, methodname, params):
+		results = Queue.Queue()
+		
+		def run(endpoint):
+			try:
+				results.put((True, self._call_one(endpoint, methodname, params)))
+			except Exception, e:
+				results.put((False, e))
+		
+		def launch(endpoint):
+			t = threading.Thread(target=run, args=(endpoint,))
+			t.daemon = True
+			t.start()
+		
+		launch(rotation[0])
+		tried = 1
+		outstanding = 1
+		try:
+			ok, value = results.get(timeout=delay)
+			outstanding -= 1
+		except Queue.Empty:
+			launch(rotation[1])
+			tried += 1
+			outstanding += 1
+			ok, value = results.get()
+			outstanding -= 1
+		
+		# Prefer any answer from the server (including a Fault) over a
+		# transport failure on one of the endpoints
+		if not ok and isinstance(value, self.transport_errors) and outstanding:
+			ok, value = results.get()
+		if not ok and isinstance(value, self.transport_errors):
+			for endpoint in rotation[tried:]:
+				try:
+					return self._call_one(endpoint, methodname, params)
+				except self.transport_errors, e:
+					value = e
+		if not ok:
+			raise value
+		return value
+	
+	def check_health(self):
+		"""
+		Calls system.listMethods on every endpoint and takes the ones that
+		fail, or don't answer within health_timeout seconds, out of rotation.
+		
+		Returns:
+			list. URLs of the endpoints that responded.
+		"""
+		for endpoint in self.endpoints:
+			try:
+				endpoint.health_proxy(self.health_timeout).system.listMethods()
+			except xmlrpclib.Fault:
+				endpoint.mark_up()
+			except self.transport_errors:
+				endpoint.mark_down()
+			else:
+				endpoint.mark_up()
+		return [e.url for e in self.endpoints if e.healthy]
+
 class Blog(object):
 	"""
 	Base class for all blog objects.
 	"""
-	def __init__(self, serverapi, username, password, default_blog_id=None, appkey='0x001'):
+	# Calls without side effects, which may be sent to any endpoint
+	read_methods = [
+		'metaWeblog.getRecentPosts',
+		'metaWeblog.getPost',
+		'metaWeblog.getCategories',
+		'metaWeblog.getTemplate',
+		'wp.getPages',
+		'wp.getPage',
+		'wp.getPageList',
+		'wp.getAuthors',
+		'wp.getCommentCount',
+		'wp.getPostStatusList',
+		'wp.getPageStatusList',
+		'wp.getOptions',
+		'wp.suggestCategories',
+		'mt.getCategoryList',
+		'mt.getPostCategories',
+		'mt.getRecentPostTitles',
+	]
+	
+	def __init__(self, serverapi, username, password, default_blog_id=None, appkey='0x001', hedge_percentile=None, health_interval=None):
 		"""
 		Args:
-			serverapi = URL to the XML-RPC API.
+			serverapi = URL to the XML-RPC API, or a list of URLs serving the same blog.
 			username  = Username for the Blog account.
 			password  = Password for the Blog account.
+			hedge_percentile = Latency percentile after which a read is also sent to a second URL [optional]
+			health_interval = Seconds between background health checks of the URLs; call close() to stop them [optional]
 		"""
 		self.username = username
 		self.password = password
@@ -42,13 +484,35 @@ class Blog(object):
 		if default_blog_id is not None:
 			self.default_blog_id = default_blog_id
 
-		# Check if URL exists
-		if not checkURL(serverapi):
+		self._connect(serverapi, hedge_percentile, health_interval)
+		self.list_methods()
+
+	def _connect(self, serverapi, hedge_percentile=None, health_interval=None):
+		if isinstance(serverapi, basestring):
+			serverapi = [serverapi]
+		self.endpoints = EndpointPool(serverapi, hedge_percentile=hedge_percentile, health_interval=health_interval)
+
+		# Check if URL exists. Unreachable URLs are taken out of rotation.
+		for endpoint in self.endpoints.endpoints:
+			if not checkURL(endpoint.url):
+				endpoint.mark_down()
+		if not [e for e in self.endpoints.endpoints if e.healthy]:
 			raise BlogError('XML-RPC API URL not found.')
 
-		# Connect to the api. Call listMethods to keep a dictionary of available methods
-		self.server             = xmlrpclib.ServerProxy(serverapi)
-		self.list_methods()
+		# Connect to the api. Writes and listMethods go to the first reachable URL.
+		self._primary           = self.endpoints.healthy()[0]
+		self.server             = xmlrpclib.ServerProxy(self._primary.url)
+
+	def _call(self, methodname, params):
+		if len(self.endpoints) > 1 and methodname in self.read_methods:
+			return self.endpoints.call(methodname, params)
+		# self.server can't be shared between threads; use this thread's proxy
+		return getattr(self._primary.proxy(), methodname)(*params)
+
+	def _stream(self, methodname, params):
+		if len(self.endpoints) > 1 and methodname in self.read_methods:
+			return self.endpoints.stream(methodname, params)
+		return self._primary.stream(methodname, params)
 
 	def list_methods(self):
 		"""Call systen.listMethods on server.
@@ -77,11 +541,30 @@ class Blog(object):
 			raise BlogError(BlogError.METHOD_NOT_SUPPORTED)
 
 		try:
-			r = getattr(self.server, methodname)(args)
+			r = self._call(methodname, (args,))
 		except xmlrpclib.Fault, fault:
 			raise BlogError(fault.faultString)
 
 		return r
+
+	def execute_iter(self, methodname, *args):
+		"""
+		Like execute, for methods returning an array. Yields each element as
+		soon as it has been parsed from the response instead of building the
+		whole list first.
+
+		Args:
+		   methodname = XML-RPC methodname.
+		   args = Arguments to the call. 
+		"""
+		if not methodname in self.methods:
+			raise BlogError(BlogError.METHOD_NOT_SUPPORTED)
+
+		try:
+			for item in self._stream(methodname, (args,)):
+				yield item
+		except xmlrpclib.Fault, fault:
+			raise BlogError(fault.faultString)
 		
 	def is_method_available(self, methodname):
 		"""Returns if a method is supported by the XML-RPC server"""
@@ -90,6 +573,10 @@ class Blog(object):
 		else:
 			return False
 
+	def close(self):
+		"""Stops the background health checks started by health_interval."""
+		self.endpoints.close()
+
 
 class MetaWeblog(Blog):
 	"""
@@ -97,8 +584,8 @@ class MetaWeblog(Blog):
 	This class extends Blog to implement metaWeblog API
 	"""
 
-	def __init__(self, serverapi, username, password, default_blog_id, appkey='0x001'):
-		Blog.__init__(self, serverapi, username, password, appkey, default_blog_id)
+	def __init__(self, serverapi, username, password, default_blog_id, appkey='0x001', hedge_percentile=None, health_interval=None):
+		Blog.__init__(self, serverapi, username, password, appkey, default_blog_id, hedge_percentile=hedge_percentile, health_interval=health_interval)
 		
 	def get_recent_posts(self, numposts=10, blog_id=None):
 		"""
@@ -114,6 +601,21 @@ class MetaWeblog(Blog):
 			blog_id = self.default_blog_id
 		return self.execute('metaWeblog.getRecentPosts', blog_id, self.username, self.password, numposts)
 	
+	def iter_recent_posts(self, numposts=10, blog_id=None):
+		"""
+		Same as get_recent_posts, but yields each post as soon as it has been
+		parsed from the response.
+		
+		Args:
+			blog_id (int): Blog ID
+			numposts (int): Number of posts to be returned [optional]
+		"""
+		if blog_id is None:
+			if self.default_blog_id is None:
+				raise BlogError("No blog_id passed")
+			blog_id = self.default_blog_id
+		return self.execute_iter('metaWeblog.getRecentPosts', blog_id, self.username, self.password, numposts)
+	
 	def get_post(self, post_id):
 		"""
 		Returns dictionary based post content corresponding to post_id.
@@ -254,8 +756,8 @@ class WordPress(MetaWeblog):
 	
 	default_blog_id = 1
 	
-	def __init__(self, serverapi, username, password, default_blog_id=1):
-		MetaWeblog.__init__(self, serverapi, username, password, default_blog_id=default_blog_id)
+	def __init__(self, serverapi, username, password, default_blog_id=1, hedge_percentile=None, health_interval=None):
+		MetaWeblog.__init__(self, serverapi, username, password, default_blog_id=default_blog_id, hedge_percentile=hedge_percentile, health_interval=health_interval)
 		
 	def get_post_status_list(self, blog_id=None):
 		"""
@@ -315,6 +817,16 @@ class WordPress(MetaWeblog):
 		
 		return self.execute('wp.getPages', blog_id, self.username, self.password)
 
+	def iter_pages(self, blog_id=None):
+		"""
+		Same as get_pages, but yields each page as soon as it has been parsed
+		from the response.
+		"""
+		if blog_id is None:
+			blog_id = self.default_blog_id
+		
+		return self.execute_iter('wp.getPages', blog_id, self.username, self.password)
+
 	def get_page(self, page_id, blog_id=None):
 		"""
 		Returns the content of page identified by page_id
@@ -451,19 +963,15 @@ class MovableType(MetaWeblog):
 		"mt_tags",
 	]
 	
-	def __init__(self, serverapi, username, password, default_blog_id=None):
+	def __init__(self, serverapi, username, password, default_blog_id=None, hedge_percentile=None, health_interval=None):
 		self.username = username
 		self.password = password
 		
 		if default_blog_id is not None:
 			self.default_blog_id = default_blog_id
 
-		# Check if URL exists
-		if not checkURL(serverapi):
-			raise BlogError('XML-RPC API URL not found.')
-
 		# Connect to the api. Call mt.supportedMethods to keep a dictionary of available methods
-		self.server = xmlrpclib.ServerProxy(serverapi)
+		self._connect(serverapi, hedge_percentile, health_interval)
 		self.list_methods()
 	
 	def list_methods(self):
@@ -480,12 +988,22 @@ class MovableType(MetaWeblog):
 			raise BlogError(BlogError.METHOD_NOT_SUPPORTED)
 		
 		try:
-			r = getattr(self.server, methodname)(*args)
+			r = self._call(methodname, args)
 		except xmlrpclib.Fault, fault:
 			raise BlogError(fault.faultString)
 		
 		return r
 	
+	def execute_iter(self, methodname, *args):
+		if not methodname in self.methods:
+			raise BlogError(BlogError.METHOD_NOT_SUPPORTED)
+		
+		try:
+			for item in self._stream(methodname, args):
+				yield item
+		except xmlrpclib.Fault, fault:
+			raise BlogError(fault.faultString)
+	
 	def _parse_custom_fields(self, content):
 		if not isinstance(content, dict):
 			raise BlogError(
@@ -698,6 +1216,419 @@ class MovableType(MetaWeblog):
 		
 		return self.execute('metaWeblog.newPost', blog_id, self.username, self.password, content, publish)
 	
+class FlushError(BlogError):
+	"""
+	Raised by WriteBehindBuffer.flush when some writes could not be sent.
+	
+	errors maps blog_id (options) or (blog_id, template_type) (templates) to
+	the exception raised for it. Writes rejected by the server (BlogError)
+	are dropped; writes that hit a transport error stay queued. results holds
+	the wp.setOptions return values of the blogs that were flushed.
+	"""
+	
+	def __init__(self, errors, results):
+		BlogError.__init__(self, "%d write(s) failed: %s" % (len(errors),
+			'; '.join('%s: %s' % (key, e) for key, e in errors.items())))
+		self.errors = errors
+		self.results = results
+
+class WriteBehindBuffer(object):
+	"""
+	Write-behind buffer for option and template writes.
+	
+	Pending wp.setOptions writes are merged per blog and sent as a single call.
+	Writes whose value matches the last snapshot read through get_options or
+	get_template are dropped. The buffer is flushed when max_pending writes are
+	queued, every flush_interval seconds (if set), or when flush() is called.
+	Writes that fail with a transport error stay queued and a timed flush
+	retries them every flush_interval seconds. Writes the server rejects are
+	dropped; flush() raises them in a FlushError, and those from timed flushes
+	are kept for failed(). The flush timer does not keep the process alive,
+	so call close() before exiting; a closed buffer refuses new writes.
+	
+	The timer flushes from its own thread. Blog calls use a connection per
+	thread, so the blog can still be used from other threads meanwhile.
+	
+	Usage:
+		buf = pyblog.WriteBehindBuffer(blog, max_pending=50, flush_interval=5)
+		buf.set_options({'blog_title': 'My Blog'})
+		buf.set_options({'blog_tagline': 'Just another blog'})
+		buf.flush()    # one wp.setOptions call
+	"""
+	
+	def __init__(self, blog, max_pending=50, flush_interval=None):
+		"""
+		Args:
+			blog (Blog): MetaWeblog or WordPress instance the writes are sent through.
+			max_pending (int): Number of queued writes that triggers a flush.
+			flush_interval (float): Seconds after the first queued write before a flush [optional]
+		"""
+		self.blog = blog
+		self.max_pending = max_pending
+		self.flush_interval = flush_interval
+		self._lock = threading.RLock()
+		self._timer = None
+		# blog_id -> {option name: value}
+		self._options = {}
+		# (blog_id, template_type) -> template
+		self._templates = {}
+		# blog_id -> {option name: value} as last seen on the server
+		self._option_snapshot = {}
+		# (blog_id, template_type) -> template as last seen on the server
+		self._template_snapshot = {}
+		# Writes rejected by the server during timed flushes
+		self._failed = {}
+		self._closed = False
+	
+	def _blog_id(self, blog_id):
+		if blog_id is None:
+			blog_id = getattr(self.blog, 'default_blog_id', None)
+			if blog_id is None:
+				raise BlogError("No blog_id passed")
+		return blog_id
+	
+	def _update_option_snapshot(self, blog_id, options):
+		# wp.getOptions/wp.setOptions return {name: {'desc', 'readonly', 'value'}}
+		snapshot = self._option_snapshot.setdefault(blog_id, {})
+		for name, details in options.items():
+			if isinstance(details, dict) and 'value' in details:
+				snapshot[name] = details['value']
+	
+	def get_options(self, options=[], blog_id=None):
+		"""
+		Reads options through the blog and caches the values as the snapshot
+		later writes are compared against. Pending writes are not flushed.
+		"""
+		blog_id = self._blog_id(blog_id)
+		r = self.blog.get_options(options, blog_id=blog_id)
+		with self._lock:
+			self._update_option_snapshot(blog_id, r)
+		return r
+	
+	def get_template(self, template_type, blog_id=None):
+		"""
+		Reads a template through the blog and caches it as the snapshot later
+		writes are compared against.
+		"""
+		blog_id = self._blog_id(blog_id)
+		r = self.blog.get_template(template_type, blog_id=blog_id)
+		with self._lock:
+			self._template_snapshot[(blog_id, template_type)] = r
+		return r
+	
+	def set_options(self, option, blog_id=None):
+		"""
+		Queues option name/value pairs for blog_id. A later write to the same
+		option replaces the queued value.
+		
+		Returns:
+			int. Number of writes pending after this call.
+		"""
+		blog_id = self._blog_id(blog_id)
+		with self._lock:
+			if self._closed:
+				raise BlogError("WriteBehindBuffer is closed")
+			snapshot = self._option_snapshot.get(blog_id, {})
+			pending = self._options.setdefault(blog_id, {})
+			for name, value in option.items():
+				if name in snapshot and snapshot[name] == value:
+					# Already the server value; drop any queued change as well
+					pending.pop(name, None)
+				else:
+					pending[name] = value
+			if not pending:
+				del self._options[blog_id]
+			return self._queued()
+	
+	def set_template(self, template, template_type, blog_id=None):
+		"""
+		Queues a template write. Only the last template queued for a given
+		template_type is sent.
+		
+		Returns:
+			int. Number of writes pending after this call.
+		"""
+		blog_id = self._blog_id(blog_id)
+		key = (blog_id, template_type)
+		with self._lock:
+			if self._closed:
+				raise BlogError("WriteBehindBuffer is closed")
+			if key in self._template_snapshot and self._template_snapshot[key] == template:
+				self._templates.pop(key, None)
+			else:
+				self._templates[key] = template
+			return self._queued()
+	
+	def pending(self):
+		"""Returns the number of writes waiting to be flushed."""
+		with self._lock:
+			return sum(len(o) for o in self._options.values()) + len(self._templates)
+	
+	def _queued(self):
+		# Called with the lock held after a write has been queued
+		count = self.pending()
+		if count >= self.max_pending:
+			self.flush()
+		elif count:
+			self._start_timer()
+		return self.pending()
+	
+	def _start_timer(self):
+		# Called with the lock held
+		if self.flush_interval is not None and self._timer is None and not self._closed:
+			self._timer = threading.Timer(self.flush_interval, self._timed_flush)
+			self._timer.daemon = True
+			self._timer.start()
+	
+	def _timed_flush(self):
+		with self._lock:
+			try:
+				self.flush()
+			except FlushError, e:
+				for key, error in e.errors.items():
+					if isinstance(error, BlogError):
+						self._failed[key] = error
+				# Writes that hit a transport error stay queued; retry them on the next tick
+				if self.pending():
+					self._start_timer()
+	
+	def failed(self):
+		"""
+		Returns and forgets the writes rejected by the server during timed
+		flushes, as a dict in the same form as FlushError.errors.
+		"""
+		with self._lock:
+			failed, self._failed = self._failed, {}
+			return failed
+	
+	def flush(self):
+		"""
+		Sends all pending writes: one wp.setOptions call per blog and one
+		metaWeblog.setTemplate call per template. A failed write does not stop
+		the others from being sent; FlushError is raised afterwards if any failed.
+		
+		Returns:
+			dict. blog_id -> wp.setOptions return value for each blog flushed.
+		"""
+		with self._lock:
+			if self._timer is not None:
+				self._timer.cancel()
+				self._timer = None
+			
+			results = {}
+			errors = {}
+			for blog_id in self._options.keys():
+				try:
+					r = self.blog.set_options(self._options[blog_id], blog_id=blog_id)
+				except BlogError, e:
+					# Rejected by the server; retrying won't help
+					del self._options[blog_id]
+					errors[blog_id] = e
+					continue
+				except EndpointPool.transport_errors, e:
+					errors[blog_id] = e
+					continue
+				del self._options[blog_id]
+				if isinstance(r, dict):
+					self._update_option_snapshot(blog_id, r)
+				results[blog_id] = r
+			
+			for key in self._templates.keys():
+				blog_id, template_type = key
+				template = self._templates[key]
+				try:
+					self.blog.set_template(template, template_type, blog_id=blog_id)
+				except BlogError, e:
+					del self._templates[key]
+					errors[key] = e
+					continue
+				except EndpointPool.transport_errors, e:
+					errors[key] = e
+					continue
+				del self._templates[key]
+				self._template_snapshot[key] = template
+			
+			if errors:
+				raise FlushError(errors, results)
+			return results
+	
+	def close(self):
+		"""
+		Flushes pending writes, stops the flush timer and stops accepting
+		new writes.
+		"""
+		with self._lock:
+			self._closed = True
+			self.flush()
+
+class RebuildHandle(object):
+	"""
+	Handle for a rebuild queued with RebuildScheduler.
+	"""
+	
+	def __init__(self, post_id):
+		self.post_id = post_id
+		self._event = threading.Event()
+		self._result = None
+		self._error = None
+	
+	def _finish(self, result=None, error=None):
+		self._result = result
+		self._error = error
+		self._event.set()
+	
+	def done(self):
+		"""Returns True once the rebuild has run (successfully or not)."""
+		return self._event.is_set()
+	
+	def wait(self, timeout=None):
+		"""
+		Blocks until the rebuild has run.
+		
+		Args:
+			timeout (float): Seconds to wait [optional]
+		
+		Returns:
+			The mt.publishPost return value. Raises the rebuild's error if it
+			failed, or BlogError if the timeout expires first.
+		"""
+		if not self._event.wait(timeout):
+			raise BlogError("Rebuild of post %s still pending" % self.post_id)
+		if self._error is not None:
+			raise self._error
+		return self._result
+
+class RebuildScheduler(object):
+	"""
+	Debounces MovableType.publish_post calls and runs the rebuilds in the background.
+	
+	A rebuild requested for a post that already has one queued is merged into
+	the queued one, and its start is pushed back by delay seconds (but never
+	more than max_delay seconds after the first request). At most max_workers
+	rebuilds run at once, and a post is never rebuilt twice concurrently.
+	
+	Usage:
+		scheduler = pyblog.RebuildScheduler(blog, delay=2, max_workers=2)
+		handle = scheduler.schedule(post_id)
+		handle.wait()
+	"""
+	
+	def __init__(self, blog, delay=2.0, max_workers=2, max_delay=None):
+		"""
+		Args:
+			blog (MovableType): Blog the rebuilds are published through.
+			delay (float): Quiet period in seconds before a rebuild starts.
+			max_workers (int): Number of rebuilds allowed to run at once.
+			max_delay (float): Longest a rebuild can be pushed back, in seconds [optional]
+		"""
+		if max_workers < 1:
+			raise BlogError("max_workers must be at least 1")
+		self.blog = blog
+		self.delay = delay
+		self.max_workers = max_workers
+		self.max_delay = max_delay
+		self._cond = threading.Condition()
+		self._queue = Queue.Queue()
+		# post_id -> [deadline, first request time, handle]
+		self._pending = {}
+		self._running = set()
+		self._threads = []
+		self._closed = False
+	
+	def _start(self):
+		# Called with the condition held
+		if self._threads:
+			return
+		t = threading.Thread(target=self._dispatch)
+		t.daemon = True
+		self._threads.append(t)
+		for i in range(self.max_workers):
+			w = threading.Thread(target=self._work)
+			w.daemon = True
+			self._threads.append(w)
+		for t in self._threads:
+			t.start()
+	
+	def schedule(self, post_id):
+		"""
+		Requests a rebuild of post_id.
+		
+		Returns:
+			RebuildHandle. Shared by every request merged into the same rebuild.
+		"""
+		now = time.time()
+		with self._cond:
+			if self._closed:
+				raise BlogError("RebuildScheduler is closed")
+			entry = self._pending.get(post_id)
+			if entry is None:
+				entry = [None, now, RebuildHandle(post_id)]
+				self._pending[post_id] = entry
+			entry[0] = now + self.delay
+			if self.max_delay is not None:
+				entry[0] = min(entry[0], entry[1] + self.max_delay)
+			self._start()
+			self._cond.notify_all()
+			return entry[2]
+	
+	def pending(self):
+		"""Returns the post IDs waiting to be rebuilt."""
+		with self._cond:
+			return self._pending.keys()
+	
+	def _dispatch(self):
+		with self._cond:
+			while True:
+				now = time.time()
+				wake = None
+				for post_id, entry in self._pending.items():
+					if post_id in self._running:
+						continue
+					if self._closed or entry[0] <= now:
+						del self._pending[post_id]
+						self._running.add(post_id)
+						self._queue.put(entry[2])
+					elif wake is None or entry[0] < wake:
+						wake = entry[0]
+				if self._closed and not self._pending:
+					break
+				if wake is None:
+					self._cond.wait()
+				else:
+					self._cond.wait(max(wake - now, 0))
+		for i in range(self.max_workers):
+			self._queue.put(None)
+	
+	def _work(self):
+		while True:
+			handle = self._queue.get()
+			if handle is None:
+				break
+			try:
+				r = self.blog.publish_post(handle.post_id)
+			except Exception, e:
+				handle._finish(error=e)
+			else:
+				handle._finish(result=r)
+			with self._cond:
+				self._running.discard(handle.post_id)
+				self._cond.notify_all()
+	
+	def close(self, wait=True):
+		"""
+		Starts every pending rebuild immediately and stops accepting new ones.
+		
+		Args:
+			wait (bool): Block until all rebuilds have finished.
+		"""
+		with self._cond:
+			self._closed = True
+			self._cond.notify_all()
+			threads = list(self._threads)
+		if wait:
+			for t in threads:
+				t.join()
+
 def main():
 	pass
 	
@@ -0,0 +1,60 @@
+import threading
+import time
+import unittest
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from SocketServer import ThreadingMixIn
+
+import pyblog
+
+
+class QuietHandler(SimpleXMLRPCRequestHandler):
+	def log_message(self, *args):
+		pass
+
+class ThreadedXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+	daemon_threads = True
+
+class RebuildSchedulerTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.published = []
+		self.server = ThreadedXMLRPCServer(('127.0.0.1', 0), requestHandler=QuietHandler, logRequests=False)
+		self.server.register_function(lambda: ['mt.publishPost'], 'mt.supportedMethods')
+		self.server.register_function(self.publish_post, 'mt.publishPost')
+		thread = threading.Thread(target=self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+		url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+		self.blog = pyblog.MovableType(url, 'username', 'password', default_blog_id=1)
+	
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+	
+	def publish_post(self, post_id, username, password):
+		# Slow enough that the workers' requests overlap
+		time.sleep(0.1)
+		self.published.append(post_id)
+		return True
+	
+	def test_concurrent_rebuilds(self):
+		scheduler = pyblog.RebuildScheduler(self.blog, delay=0, max_workers=4)
+		handles = [scheduler.schedule(post_id) for post_id in range(8)]
+		for handle in handles:
+			self.assertEqual(handle.wait(5), True)
+		scheduler.close()
+		self.assertEqual(sorted(self.published), range(8))
+	
+	def test_debounce(self):
+		scheduler = pyblog.RebuildScheduler(self.blog, delay=0.2, max_workers=2)
+		handles = [scheduler.schedule(1) for i in range(5)]
+		self.assertTrue(all(h is handles[0] for h in handles))
+		handles[0].wait(5)
+		scheduler.close()
+		self.assertEqual(self.published, [1])
+	
+	def test_max_workers(self):
+		self.assertRaises(pyblog.BlogError, pyblog.RebuildScheduler, self.blog, max_workers=0)
+
+if __name__ == '__main__':
+	unittest.main()